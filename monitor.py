@@ -8,199 +8,466 @@ import smtplib
 import os
 import json
 import sys
-from playwright.sync_api import sync_playwright, TimeoutError
+import asyncio
+import random
+import re
+import time
+import hashlib
+from dataclasses import dataclass
+from urllib.parse import urlparse
+import aiohttp
+from playwright.async_api import async_playwright, TimeoutError, Error as PlaywrightError
 from email.mime.text import MIMEText
-from datetime import datetime
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 
-def check_product_availability(url: str, pincode: str, pincode_input_selector: str, pincode_select_selector: str, cart_button_selector: str):
+@dataclass(slots=True, frozen=True)
+class Product:
+    """A monitored product; name doubles as its key in the status file"""
+    name: str
+    url: str
+    pincode: str
+    pincode_input_selector: str
+    pincode_select_selector: str
+    cart_button_selector: str
+    alias: str
+
+def make_product(name, url, pincode, pincode_input_selector, pincode_select_selector, cart_button_selector):
+    """Build a Product, precomputing the API alias from the last segment of its URL"""
+    return Product(
+        name=name,
+        url=url,
+        pincode=pincode,
+        pincode_input_selector=pincode_input_selector,
+        pincode_select_selector=pincode_select_selector,
+        cart_button_selector=cart_button_selector,
+        alias=urlparse(url).path.rstrip('/').rsplit('/', 1)[-1],
+    )
+
+PRODUCTS = [
+    make_product(
+        name='Lassi',
+        url='https://shop.amul.com/en/product/amul-high-protein-plain-lassi-200-ml-or-pack-of-30',
+        pincode='560037',
+        pincode_input_selector='#search',
+        pincode_select_selector='.searchitem-name',
+        cart_button_selector='.add-to-cart[title="Add to Cart"]',
+    ),
+]
+
+STATUS_FILE = 'status.json'
+
+# Don't resend the same notification within this window, even if a product flaps
+NOTIFY_TTL_SECONDS = 2 * 3600
+
+# Storefront JSON API, used before falling back to a full browser check
+API_BASE_URL = 'https://shop.amul.com'
+API_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36',
+    'Accept': 'application/json',
+    'Referer': f'{API_BASE_URL}/',
+    'frontend': '1',
+}
+API_TIMEOUT = aiohttp.ClientTimeout(total=15)
+MAX_API_RESPONSE_BYTES = 512 * 1024
+
+# Pincode -> substore mappings rarely change, so cache them across runs
+SUBSTORE_TTL_SECONDS = 24 * 3600
+
+# CSS class fragments that mark an 'Add to Cart' button as disabled, scanned in one regex pass
+DISABLED_CLASSES = ['disabled', 'inactive', 'not-available', 'sold-out', 'out-of-stock']
+DISABLED_CLASS_PATTERN = re.compile('|'.join(re.escape(c) for c in DISABLED_CLASSES))
+
+class ApiSchemaError(Exception):
+    """Raised when an API response doesn't have the shape the monitor expects"""
+
+# Navigation retry policy: bounded exponential backoff with jitter
+MAX_ATTEMPTS = 6
+MAX_BACKOFF_SECONDS = 30
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+def retry_after_seconds(value):
+    """Parse a Retry-After header (delta-seconds or HTTP-date), if present"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+async def goto_with_backoff(page, url):
     """
-    Checks product availability by finding the 'Add to Cart' button and checking if it is enabled.
+    Navigate to url, retrying 429/5xx responses and network errors with exponential backoff.
+    Other 4xx responses are returned as-is without retrying.
     """
-    with sync_playwright() as p:
-        browser = None
+    for attempt in range(MAX_ATTEMPTS):
+        is_last_attempt = attempt == MAX_ATTEMPTS - 1
+        delay = min(MAX_BACKOFF_SECONDS, 0.5 * 2 ** attempt) + random.uniform(0, 0.5)
         try:
-            print(" Launching browser...")
-            browser = p.chromium.launch(headless=True)
-            page = browser.new_page()
+            response = await page.goto(url, wait_until="domcontentloaded", timeout=60000)
+        except PlaywrightError as e:
+            if is_last_attempt:
+                raise
+            print(f" Navigation failed ({e}), retrying in {delay:.1f}s...")
+        else:
+            if response is None or response.status not in RETRYABLE_STATUSES:
+                return response
+            if is_last_attempt:
+                raise RuntimeError(f"{url} returned HTTP {response.status} after {MAX_ATTEMPTS} attempts")
+            retry_after = retry_after_seconds(response.headers.get('retry-after'))
+            if retry_after is not None:
+                delay = min(MAX_BACKOFF_SECONDS, retry_after)
+            print(f" Got HTTP {response.status}, retrying in {delay:.1f}s...")
+        await asyncio.sleep(delay)
 
-            print(f"Navigating to {url}...")
-            page.goto(url, wait_until="domcontentloaded", timeout=60000)
+async def fetch_api_json(session, path, params, cookies=None):
+    """GET a storefront API endpoint and decode its JSON body, reading at most MAX_API_RESPONSE_BYTES"""
+    async with session.get(f"{API_BASE_URL}{path}", params=params, cookies=cookies, timeout=API_TIMEOUT) as response:
+        response.raise_for_status()
+        chunks = []
+        total = 0
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            total += len(chunk)
+            if total > MAX_API_RESPONSE_BYTES:
+                raise ApiSchemaError(f"{path} response is larger than {MAX_API_RESPONSE_BYTES} bytes")
+            chunks.append(chunk)
+        return json.loads(b''.join(chunks))
 
-            print(f" Typing pincode '{pincode}' into input '{pincode_input_selector}'...")
-            page.locator(pincode_input_selector).fill(pincode)
-            
-            print(f" Clicking on pincode dropdown element '{pincode_select_selector}'...")
-            page.locator(pincode_select_selector).click()
-            
-            # --- IMPROVED BUTTON CLICKABILITY CHECK ---
-            print(f"Locating the 'Add to Cart' button ('{cart_button_selector}')...")
-            
-            # First, wait for the button to exist and be visible on the page.
-            cart_button = page.locator(cart_button_selector)
-            cart_button.wait_for(state="visible", timeout=15000)
-            
-            # Multi-step check to determine if button is truly clickable
-            is_clickable = check_button_clickability(page, cart_button)
-            
-            if is_clickable:
-                print(" Product is IN STOCK ('Add to Cart' button is clickable).")
-                return True, "In Stock"
-            else:
-                print(" Product is OUT OF STOCK ('Add to Cart' button is not clickable).")
-                return False, "Out of Stock"
-
-        except TimeoutError:
-            # This error now means the 'Add to Cart' button was not found at all.
-            print("CRITICAL ERROR: Could not find the 'Add to Cart' button.", file=sys.stderr)
-            print("The website structure may have changed, or the page failed to load properly.", file=sys.stderr)
-            sys.exit(1)
-        except Exception as e:
-            print(f" An unexpected error occurred: {e}", file=sys.stderr)
-            sys.exit(1)
-        finally:
-            if browser:
-                browser.close()
-                print("Browser closed.")
+async def resolve_substore(session, pincode: str):
+    """Look up the substore that serves a pincode"""
+    print(f" Resolving pincode '{pincode}' via API...")
+    pincode_data = await fetch_api_json(session, '/entity/pincode', params={
+        'limit': 50,
+        'filters[0][field]': 'pincode',
+        'filters[0][value]': pincode,
+        'filters[0][operator]': 'regex',
+    })
+    try:
+        return pincode_data['records'][0]['substore']
+    except (KeyError, IndexError, TypeError):
+        raise ApiSchemaError(f"no substore in pincode response for '{pincode}'")
 
-def check_button_clickability(page, button):
+async def check_product_via_api(session, product: Product, substores: dict):
     """
-    Comprehensive check to determine if a button is truly clickable
+    Checks product availability with the storefront's JSON API instead of a browser.
+    Resolves the pincode to its substore, then reads the product's 'available' flag there.
+    Pincode lookups are cached in substores, which is persisted in the status file.
     """
+    alias = product.alias
+    pincode = product.pincode
+    
+    cached = substores.get(pincode)
+    if cached:
+        substore = cached['substore']
+    else:
+        substore = await resolve_substore(session, pincode)
+        substores[pincode] = {'substore': substore, 'expires_at': time.time() + SUBSTORE_TTL_SECONDS}
+    
+    print(f" Fetching stock for '{alias}' from API...")
     try:
-        # Check 1: Traditional disabled attribute
-        if not button.is_enabled():
-            print(" Button is disabled (disabled attribute)")
-            return False
+        product_data = await fetch_api_json(session, '/api/1/entity/ms.products', params={
+            'fields[alias]': 1,
+            'fields[available]': 1,
+            'q': json.dumps({'alias': alias}),
+            'limit': 1,
+            'substore': substore,
+        }, cookies={'substore': substore})
+        try:
+            available = product_data['data'][0]['available']
+        except (KeyError, IndexError, TypeError):
+            raise ApiSchemaError(f"no 'available' field in product response for '{alias}'")
+    except Exception:
+        # The cached substore may be stale; resolve it again on the next run
+        substores.pop(pincode, None)
+        raise
+    
+    if available:
+        print(" Product is IN STOCK (API reports available).")
+        return True, "In Stock"
+    else:
+        print(" Product is OUT OF STOCK (API reports unavailable).")
+        return False, "Out of Stock"
+
+async def check_product_availability(browser, url: str, pincode: str, pincode_input_selector: str, pincode_select_selector: str, cart_button_selector: str):
+    """
+    Checks product availability by finding the 'Add to Cart' button and checking if it is enabled.
+    Each check runs in its own isolated context on the shared browser.
+    """
+    context = None
+    try:
+        context = await browser.new_context()
+        page = await context.new_page()
+
+        print(f"Navigating to {url}...")
+        await goto_with_backoff(page, url)
+
+        print(f" Typing pincode '{pincode}' into input '{pincode_input_selector}'...")
+        await page.locator(pincode_input_selector).fill(pincode)
         
-        # Check 2: Check for disabled-looking CSS classes
-        button_classes = button.get_attribute('class') or ""
-        disabled_classes = ['disabled', 'inactive', 'not-available', 'sold-out', 'out-of-stock']
+        print(f" Clicking on pincode dropdown element '{pincode_select_selector}'...")
+        await page.locator(pincode_select_selector).click()
         
-        for disabled_class in disabled_classes:
-            if disabled_class in button_classes.lower():
-                print(f" Button has disabled class: {disabled_class}")
-                return False
+        # --- IMPROVED BUTTON CLICKABILITY CHECK ---
+        print(f"Locating the 'Add to Cart' button ('{cart_button_selector}')...")
         
-        # Check 3: Check opacity (often used to visually disable buttons)
-        opacity = page.evaluate("""
+        # First, wait for the button to exist and be visible on the page.
+        cart_button = page.locator(cart_button_selector)
+        await cart_button.wait_for(state="visible", timeout=15000)
+        
+        # Multi-step check to determine if button is truly clickable
+        is_clickable = await check_button_clickability(cart_button)
+        
+        if is_clickable:
+            print(" Product is IN STOCK ('Add to Cart' button is clickable).")
+            return True, "In Stock"
+        else:
+            print(" Product is OUT OF STOCK ('Add to Cart' button is not clickable).")
+            return False, "Out of Stock"
+
+    except TimeoutError:
+        # This error now means the 'Add to Cart' button was not found at all.
+        print("CRITICAL ERROR: Could not find the 'Add to Cart' button.", file=sys.stderr)
+        print("The website structure may have changed, or the page failed to load properly.", file=sys.stderr)
+        raise
+    except Exception as e:
+        print(f" An unexpected error occurred: {e}", file=sys.stderr)
+        raise
+    finally:
+        if context:
+            await context.close()
+
+async def check_button_clickability(button):
+    """
+    Comprehensive check to determine if a button is truly clickable
+    """
+    try:
+        # Read every signal in a single browser round-trip
+        state = await button.evaluate("""
             (button) => {
                 const style = window.getComputedStyle(button);
-                return parseFloat(style.opacity);
+                return {
+                    disabled: button.disabled || button.getAttribute('aria-disabled') === 'true',
+                    classes: button.className || '',
+                    opacity: parseFloat(style.opacity),
+                    pointerEvents: style.pointerEvents,
+                };
             }
-        """, button.element_handle())
+        """)
         
-        if opacity < 0.5:  # Very low opacity suggests disabled
-            print(f" Button has low opacity: {opacity}")
+        # Check 1: Traditional disabled attribute
+        if state['disabled']:
+            print(" Button is disabled (disabled attribute)")
             return False
         
-        # Check 6: Try to check if button is actually clickable by checking pointer events
-        pointer_events = page.evaluate("""
-            (button) => {
-                const style = window.getComputedStyle(button);
-                return style.pointerEvents;
-            }
-        """, button.element_handle())
+        # Check 2: Check for disabled-looking CSS classes
+        match = DISABLED_CLASS_PATTERN.search(state['classes'].lower())
+        if match:
+            print(f" Button has disabled class: {match.group(0)}")
+            return False
         
-        if pointer_events == 'none':
-            print(" Button has pointer-events: none")
+        # Check 3: Check opacity (often used to visually disable buttons)
+        if state['opacity'] < 0.5:  # Very low opacity suggests disabled
+            print(f" Button has low opacity: {state['opacity']}")
             return False
         
-        # Check 7: Final test - try to hover and see if it responds
-        try:
-            button.hover(timeout=2000)
-            print(" Button passed all clickability checks")
-            return True
-        except:
-            print(" Button failed hover test")
+        # Check 4: Check if button is actually clickable by checking pointer events
+        if state['pointerEvents'] == 'none':
+            print(" Button has pointer-events: none")
             return False
+        
+        print(" Button passed all clickability checks")
+        return True
             
     except Exception as e:
         print(f" Error checking button clickability: {e}")
         return False
 
 
-def send_email(subject, body):
-    """Send email notification using Gmail"""
-    try:
-        from_email = os.environ.get('EMAIL_ADDRESS')
-        password = os.environ.get('EMAIL_PASSWORD')
-        to_email = from_email
-        
-        if not from_email or not password:
+class MailSender:
+    """
+    Gmail SMTP session shared by every notification in a run.
+    Connects and logs in once on enter, quits on exit.
+    """
+
+    def __init__(self):
+        self.from_email = os.environ.get('EMAIL_ADDRESS')
+        self.password = os.environ.get('EMAIL_PASSWORD')
+        self.to_email = self.from_email
+        self.server = None
+
+    def __enter__(self):
+        if not self.from_email or not self.password:
             print("❌ Email credentials not configured")
-            return False
-            
-        print(f"📧 Sending email to: {to_email}")
-        
-        msg = MIMEText(body)
-        msg['Subject'] = subject
-        msg['From'] = from_email
-        msg['To'] = to_email
+            return self
         
-        # Use Gmail SMTP
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(from_email, password)
-        server.sendmail(from_email, [to_email], msg.as_string())
-        server.quit()
-        
-        print(" Email sent successfully!")
-        return True
+        try:
+            # Use Gmail SMTP
+            server = smtplib.SMTP('smtp.gmail.com', 587)
+            server.starttls()
+            server.login(self.from_email, self.password)
+            self.server = server
+        except Exception as e:
+            print(f" Failed to connect to email server: {str(e)}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.server:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+    def send(self, subject, body):
+        """Send one email notification over the open session"""
+        if not self.server:
+            return False
         
-    except Exception as e:
-        print(f" Failed to send email: {str(e)}")
-        return False
+        try:
+            print(f"📧 Sending email to: {self.to_email}")
+            
+            msg = MIMEText(body)
+            msg['Subject'] = subject
+            msg['From'] = self.from_email
+            msg['To'] = self.to_email
+            
+            self.server.sendmail(self.from_email, [self.to_email], msg.as_string())
+            
+            print(" Email sent successfully!")
+            return True
+            
+        except Exception as e:
+            print(f" Failed to send email: {str(e)}")
+            return False
+
+def notification_signature(product_key, status):
+    """Hash identifying a notification, used to dedupe sends across runs"""
+    return hashlib.md5(f"{product_key}|{status}".encode()).hexdigest()
 
 def load_previous_status():
     """Load previous status from file (if exists)"""
     try:
-        if os.path.exists('status.json'):
-            with open('status.json', 'r') as f:
+        if os.path.exists(STATUS_FILE):
+            with open(STATUS_FILE, 'r') as f:
                 return json.load(f)
     except:
         pass
     return {}
 
 def save_status(status_data):
-    """Save current status to file"""
+    """Save current status to file, skipping the write when nothing changed"""
     try:
-        with open('status.json', 'w') as f:
-            json.dump(status_data, f)
+        new_blob = json.dumps(status_data, sort_keys=True).encode()
+        if os.path.exists(STATUS_FILE):
+            with open(STATUS_FILE, 'rb') as f:
+                if f.read() == new_blob:
+                    print(" Status unchanged, skipping write")
+                    return
+        
+        # Write to a temp file first so a crash never leaves a half-written status
+        tmp_path = f"{STATUS_FILE}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(new_blob)
+        os.replace(tmp_path, STATUS_FILE)
     except Exception as e:
         print(f"❌ Error saving status: {str(e)}")
 
 
-def main():
+async def main():
     print("🚀 Starting Product Monitor...")
     print(f" Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S UTC')}")
 
     
     # Load previous status
     previous_status = load_previous_status()
-    current_status = {}
+    now = time.time()
+    
+    # Drop expired notification signatures so the status file stays small
+    notified = {
+        signature: expires_at
+        for signature, expires_at in previous_status.get('notified', {}).items()
+        if expires_at > now
+    }
+    
+    # Reuse unexpired pincode lookups from earlier runs
+    substores = {
+        pincode: entry
+        for pincode, entry in previous_status.get('substores', {}).items()
+        if entry.get('expires_at', 0) > now
+    }
+    current_status = {'notified': notified, 'substores': substores}
     
+    pending_notifications = []
     notifications_sent = 0
+    failed_checks = 0
     
-    is_available, status = check_product_availability(
-        url='https://shop.amul.com/en/product/amul-high-protein-plain-lassi-200-ml-or-pack-of-30',
-        pincode="560037",
-        pincode_input_selector='#search',
-        pincode_select_selector='.searchitem-name',
-        cart_button_selector='.add-to-cart[title="Add to Cart"]',
-    )
+    # Run every product check concurrently against the JSON API first;
+    # failures are returned, not raised
+    async with aiohttp.ClientSession(headers=API_HEADERS) as session:
+        tasks = [check_product_via_api(session, product, substores) for product in PRODUCTS]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
     
-    current_status["Lassi"] = is_available
+    # Fall back to the browser only for products the API couldn't answer
+    fallback_indexes = [i for i, result in enumerate(results) if isinstance(result, Exception)]
+    for i in fallback_indexes:
+        print(f" API check for {PRODUCTS[i].name} failed ({results[i]!r}), falling back to browser")
     
-    # Send notification only if status changed to available
-    was_available = previous_status.get("Lassi", False)
+    if fallback_indexes:
+        async with async_playwright() as playwright:
+            print(" Launching browser...")
+            browser = await playwright.chromium.launch(headless=True)
+            tasks = [
+                check_product_availability(
+                    browser,
+                    url=PRODUCTS[i].url,
+                    pincode=PRODUCTS[i].pincode,
+                    pincode_input_selector=PRODUCTS[i].pincode_input_selector,
+                    pincode_select_selector=PRODUCTS[i].pincode_select_selector,
+                    cart_button_selector=PRODUCTS[i].cart_button_selector,
+                )
+                for i in fallback_indexes
+            ]
+            try:
+                browser_results = await asyncio.gather(*tasks, return_exceptions=True)
+            finally:
+                await browser.close()
+                print("Browser closed.")
+        for i, result in zip(fallback_indexes, browser_results):
+            results[i] = result
     
-    if is_available and not was_available:
-        print(f" Lassi became available!")
+    for product, result in zip(PRODUCTS, results):
+        name = product.name
+        was_available = previous_status.get(name, False)
         
-        subject = f" Amul Lassi is NOW AVAILABLE!"
-        body = f"""
+        if isinstance(result, Exception):
+            print(f" Check for {name} failed: {result}", file=sys.stderr)
+            failed_checks += 1
+            # Keep the last known state so a failed run doesn't re-trigger a notification
+            current_status[name] = was_available
+            continue
+        
+        is_available, status = result
+        current_status[name] = is_available
+        
+        # Send notification only if status changed to available
+        if is_available and not was_available:
+            print(f" {name} became available!")
+            
+            signature = notification_signature(name, status)
+            if now < notified.get(signature, 0):
+                print(f" {name} was already notified recently, skipping email")
+                continue
+            
+            subject = f" Amul {name} is NOW AVAILABLE!"
+            body = f"""
  Great news! Your monitored product is now available!
 
+Product: {name}
 Status: {status}
 Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S UTC')}
 
@@ -209,14 +476,21 @@ Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S UTC')}
 ---
 Monitored by GitHub Actions Product Monitor
         """
-        print(body)
-        if send_email(subject, body):
-            notifications_sent += 1
+            print(body)
+            pending_notifications.append((signature, subject, body))
+        
+        elif is_available and was_available:
+            print(f" {name} still available")
+        else:
+            print(f" {name} not available")
     
-    elif is_available and was_available:
-        print(f" Lassi still available")
-    else:
-        print(f" Lassi not available")
+    # Send every notification over one SMTP session
+    if pending_notifications:
+        with MailSender() as mailer:
+            for signature, subject, body in pending_notifications:
+                if mailer.send(subject, body):
+                    notifications_sent += 1
+                    notified[signature] = now + NOTIFY_TTL_SECONDS
     
     # Save current status
     save_status(current_status)
@@ -225,6 +499,9 @@ Monitored by GitHub Actions Product Monitor
     print(f"   Notifications sent: {notifications_sent}")
     print(f"   Status saved: ")
     print("🏁 Monitor completed!")
+    
+    if failed_checks:
+        sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file